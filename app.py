@@ -1,18 +1,25 @@
 import streamlit as st
+import asyncio
 import json
 import tekore as tk
 from dotenv import load_dotenv
 import os
+import threading
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import seaborn as sns
 from matplotlib import pyplot as plt
-from time import sleep
-from sklearn.preprocessing import RobustScaler, OneHotEncoder, LabelEncoder
-from sklearn.pipeline import Pipeline
-from sklearn.compose import ColumnTransformer
+from scipy.stats import gaussian_kde
+from sklearn.decomposition import PCA
 import umap
+from numba import njit, prange
+try:
+    from cuml.manifold import UMAP as CumlUMAP
+except ImportError:
+    CumlUMAP = None
 from datetime import timedelta
+from operator import attrgetter
 from statistics import median
 
 
@@ -35,73 +42,264 @@ def login():
         redirect_uri="http://localhost:/callback",
     )
     token = cred.request_client_token()
-    spotify = tk.Spotify(token=token)
+    spotify = tk.Spotify(token=token, sender=tk.RetryingSender(retries=3))
     return spotify
 
 
 @st.cache_data
-def load_profile(user_id):
-    spotify = login()
-    user = spotify.user(user_id)
+def load_profile(_spotify, user_id):
+    user = _spotify.user(user_id)
     return user
 
 
+AUDIO_FEATURES_BATCH_SIZE = 100 # maximum number of IDs per request to Spotify
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+PLAYLIST_ITEMS_FIELDS = "total,items(track(type,id,name,artists(name)))" # all that is used of a playlist item
+MAX_CONCURRENT_REQUESTS = 16 # stay well below Spotify's rate limit
+AUDIO_FEATURES = [
+    "acousticness", "danceability", "duration", "energy", "instrumentalness", "key", "liveness",
+    "loudness", "mode", "speechiness", "tempo", "time_signature", "valence",
+]
+CATEGORICAL_FEATURES = ["key", "mode", "time_signature"]
+NUMERIC_FEATURES = [feature for feature in AUDIO_FEATURES if feature not in CATEGORICAL_FEATURES]
+FEATURE_DTYPES = {feature: np.int8 if feature in CATEGORICAL_FEATURES else np.float32 for feature in AUDIO_FEATURES}
+
+
+FEATURES_CACHE_PATH = "features_cache.parquet"
+UNAVAILABLE_FEATURES_PATH = "features_unavailable.json"
+
+
+# audio features of a track never change, so they are kept on disk across sessions and restarts
+class FeaturesCache:
+    def __init__(self, path, unavailable_path):
+        self.path = path
+        self.unavailable_path = unavailable_path
+        self.lock = threading.Lock()
+        self.unsaved = False
+        if os.path.exists(path):
+            self.features = pd.read_parquet(path)
+        else:
+            self.features = to_features_frame([])
+        # IDs Spotify has no audio features for, so they aren't requested again on every load
+        if os.path.exists(unavailable_path):
+            with open(unavailable_path, "r") as infile:
+                self.unavailable = set(json.load(infile))
+        else:
+            self.unavailable = set()
+
+    def missing(self, track_ids):
+        return set(track_ids).difference(self.features.index).difference(self.unavailable)
+
+    def add(self, features, unavailable=()):
+        with self.lock:
+            unavailable = set(unavailable).difference(self.unavailable)
+            if len(unavailable) != 0:
+                self.unavailable.update(unavailable)
+                self.unsaved = True
+            features = features[~features.index.isin(self.features.index)]
+            if len(features) != 0:
+                self.features = pd.concat([self.features, features])
+                self.unsaved = True
+
+    def save(self):
+        with self.lock:
+            if not self.unsaved:
+                return
+            tmp_path = f"{self.path}.tmp"
+            self.features.to_parquet(tmp_path, compression="zstd")
+            os.replace(tmp_path, self.path)
+            tmp_path = f"{self.unavailable_path}.tmp"
+            with open(tmp_path, "w") as outfile:
+                json.dump(sorted(self.unavailable), outfile)
+            os.replace(tmp_path, self.unavailable_path)
+            self.unsaved = False
+
+
+@st.cache_resource
+def load_features_cache():
+    return FeaturesCache(FEATURES_CACHE_PATH, UNAVAILABLE_FEATURES_PATH)
+
+
+def to_features_frame(audio_features):
+    attributes = ["duration_ms" if feature == "duration" else feature for feature in AUDIO_FEATURES]
+    get_row = attrgetter("id", *attributes)
+    features = pd.DataFrame(
+        [get_row(features) for features in audio_features if features is not None],
+        columns=["track_id"] + AUDIO_FEATURES,
+    )
+    features["duration"] = features["duration"].to_numpy() * 1e-3
+    return features.set_index("track_id").astype(FEATURE_DTYPES)
+
+
 @st.cache_data(ttl=timedelta(hours=1))
-def load_playlists(user_id):
-    spotify = login()
-    playlists = spotify.playlists(user_id)
-    songs = []
-    for playlist in playlists.items:
-        playlist = spotify.playlist(playlist_id=playlist.id)
-        for track in spotify.all_items(playlist.tracks):
-            track = track.track
-            if track.id is None:
-                continue
-            audio_features = spotify.track_audio_features(track.id)
-            song = {
-                "playlist": playlist.name,
-                "song_interpret": ", ".join([artist.name for artist in track.artists]),
-                "song_title": track.name,
-                "acousticness": audio_features.acousticness,
-                "danceability": audio_features.danceability,
-                "duration": audio_features.duration_ms / 1e3,
-                "energy": audio_features.energy,
-                "instrumentalness": audio_features.instrumentalness,
-                "key": audio_features.key,
-                "liveness": audio_features.liveness,
-                "loudness": audio_features.loudness,
-                "mode": audio_features.mode,
-                "speechiness": audio_features.speechiness,
-                "tempo": audio_features.tempo,
-                "time_signature": audio_features.time_signature,
-                "valence": audio_features.valence,
-            }
-            songs.append(song)
-            sleep(0.1)
-    songs = pd.DataFrame.from_records(songs)
+def load_playlists(_spotify, user_id):
+    return asyncio.run(_load_playlists(_spotify.token, user_id))
+
+
+async def _load_playlists(token, user_id):
+    features_cache = load_features_cache()
+    spotify = tk.Spotify(
+        token=token,
+        sender=tk.RetryingSender(retries=3, sender=tk.AsyncSender()),
+        asynchronous=True,
+    )
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def request(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    async def load_tracks(playlist):
+        # with fields given tekore returns the raw JSON pages
+        first_page = await request(spotify.playlist_items(playlist.id, fields=PLAYLIST_ITEMS_FIELDS, limit=PLAYLIST_ITEMS_PAGE_SIZE))
+        pages = [first_page] + await asyncio.gather(*[
+            request(spotify.playlist_items(playlist.id, fields=PLAYLIST_ITEMS_FIELDS, limit=PLAYLIST_ITEMS_PAGE_SIZE, offset=offset))
+            for offset in range(PLAYLIST_ITEMS_PAGE_SIZE, first_page["total"], PLAYLIST_ITEMS_PAGE_SIZE)
+        ])
+        records = []
+        for page in pages:
+            for item in page["items"]:
+                track = item["track"]
+                if track is None or track["id"] is None or track["type"] != "track": # skip local files and podcast episodes
+                    continue
+                records.append((playlist.name, track["id"], [artist["name"] for artist in track["artists"]], track["name"]))
+        return records
+
+    async def fetch_features(track_ids):
+        # every batch goes into the shared cache as soon as it arrives, so a failing batch doesn't discard the others
+        audio_features = await request(spotify.tracks_audio_features(track_ids))
+        unavailable = [track_id for track_id, features in zip(track_ids, audio_features) if features is None]
+        features_cache.add(to_features_frame(audio_features), unavailable)
+
+    try:
+        playlists = await request(spotify.playlists(user_id))
+        records_per_playlist = await asyncio.gather(*[load_tracks(playlist) for playlist in playlists.items])
+        records = [record for playlist_records in records_per_playlist for record in playlist_records]
+        # a track in several playlists only needs its features fetched once
+        unique_ids = {track_id for _, track_id, _, _ in records}
+        missing = sorted(features_cache.missing(unique_ids))
+        await asyncio.gather(*[
+            fetch_features(missing[i:i + AUDIO_FEATURES_BATCH_SIZE])
+            for i in range(0, len(missing), AUDIO_FEATURES_BATCH_SIZE)
+        ])
+    finally:
+        await spotify.close()
+        features_cache.save()
+    known_features = features_cache.features
+    records = [record for record in records if record[1] in known_features.index]
+    songs = pd.DataFrame(
+        [(playlist_name, track_id, title) for playlist_name, track_id, _, title in records],
+        columns=["playlist", "track_id", "song_title"],
+    )
+    artists = pd.Series([artists for _, _, artists, _ in records], dtype=object)
+    songs.insert(2, "song_interpret", artists.str.join(", ").to_numpy())
+    features = known_features.loc[songs["track_id"]] # joins every row back to its track's single set of features
+    songs = songs.assign(**{feature: features[feature].to_numpy() for feature in AUDIO_FEATURES})
+    songs["title"] = songs["song_interpret"].str.cat(songs["song_title"], sep=" - ")
     return songs
 
 
+GPU_MIN_SONGS = 500 # below this, copying to the device costs more than the GPU saves
+PCA_COMPONENTS = 10
+
+
+def umap_backend(n_songs):
+    if CumlUMAP is not None and n_songs >= GPU_MIN_SONGS:
+        return CumlUMAP
+    return umap.UMAP
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def robust_scale(X):
+    # same as sklearn's RobustScaler: center on the median, scale by the interquartile range
+    n, d = X.shape
+    out = np.empty_like(X)
+    for j in prange(d):
+        col = np.ascontiguousarray(X[:, j])
+        center = np.median(col)
+        iqr = np.percentile(col, 75) - np.percentile(col, 25)
+        if iqr == 0:
+            iqr = 1.0
+        for i in range(n):
+            out[i, j] = (col[i] - center) / iqr
+    return out
+
+
+def pca_layout(X, dimensions):
+    # umap-learn 0.5.3 has no init="pca", but takes the starting coordinates as an array
+    layout = PCA(n_components=dimensions).fit_transform(X)
+    spread = np.abs(layout).max()
+    return layout if spread == 0 else 10 * layout / spread # same range as umap's own initializations
+
+
+@st.cache_resource
+def warm_up_jit():
+    # compile the numba kernels once per process in the background, so neither the first page nor the first map waits for them
+    thread = threading.Thread(target=_warm_up_jit, daemon=True)
+    thread.start()
+    return thread
+
+
+def _warm_up_jit():
+    X = robust_scale(np.asfortranarray(np.random.default_rng(42).random((50, 4), dtype=np.float32)))
+    X = np.ascontiguousarray(PCA(n_components=4).fit_transform(X), dtype=np.float32)
+    y = np.arange(len(X)) % 2 # supervised like the real fit, which compiles further kernels
+    umap.UMAP(n_neighbors=5, init=pca_layout(X, 2), n_epochs=200).fit_transform(X, y=y)
+
+
+def embed_songs(songs, dimensions=2):
+    # the library is identified by its (playlist, track) rows, one 64 bit hash per row
+    library = pd.util.hash_pandas_object(songs[["playlist", "track_id"]], index=False).to_numpy()
+    return _embed_songs(library, songs, dimensions)
+
+
 @st.cache_data
-def plot_songs(songs, dimensions=2):
+def _embed_songs(library, _songs, dimensions):
+    songs = _songs
     typical_playlist_size = songs.groupby("playlist").size().agg(median)
-    pipe = Pipeline(
-        [
-            ("encoder", ColumnTransformer([("cat", OneHotEncoder(), ["time_signature", "mode", "key"])], remainder="passthrough")),
-            ("scaler", RobustScaler()),
-            ("umap", umap.UMAP(n_components=dimensions, n_neighbors=round(typical_playlist_size/2), min_dist=0.75, random_state=42)),
-        ]
-    )
-    embedding = pipe.fit_transform(
-        X = songs.drop(["playlist", "song_title", "song_interpret"], axis=1),
-        y = LabelEncoder().fit_transform(songs["playlist"]),
+    X = np.hstack([
+        pd.get_dummies(songs[CATEGORICAL_FEATURES], columns=CATEGORICAL_FEATURES, dtype=np.float32).to_numpy(),
+        songs[NUMERIC_FEATURES].to_numpy(np.float32),
+    ])
+    X = robust_scale(X)
+    X = PCA(n_components=min(PCA_COMPONENTS, len(songs))).fit_transform(X)
+    X = np.ascontiguousarray(X, dtype=np.float32) # no-op unless PCA upcasts
+    UMAP = umap_backend(len(songs))
+    umap_args = dict(
+        n_components=dimensions,
+        n_neighbors=round(typical_playlist_size/2),
+        min_dist=0.75,
     )
-    songs["x"] = embedding[:, 0]
-    songs["y"] = embedding[:, 1]
+    if UMAP is umap.UMAP: # cuML only supports spectral and random initialization
+        umap_args["init"] = pca_layout(X, dimensions)
+        umap_args["n_epochs"] = 200 if len(songs) < 2000 else 100 # a PCA start needs fewer epochs to converge
+        # no random_state: umap-learn only runs its SGD epochs in parallel without one, at the cost of a reproducible layout
+    else:
+        umap_args["random_state"] = 42
+    embedding = UMAP(**umap_args).fit_transform(X, y=songs["playlist"].factorize()[0])
+    return embedding
+
+
+MAX_PLOT_POINTS = 5000 # beyond this, serializing and rendering the plot makes the browser sluggish
+MIN_POINTS_PER_PLAYLIST = 50
+
+
+def sample_per_playlist(songs, max_points=MAX_PLOT_POINTS):
+    # positions of a random sample that keeps every playlist's share of the songs
+    rng = np.random.default_rng(42)
+    positions = pd.Series(np.arange(len(songs))).groupby(songs["playlist"].to_numpy())
+    sample = [
+        rng.choice(group, size=min(len(group), max(MIN_POINTS_PER_PLAYLIST, int(max_points * len(group) / len(songs)))), replace=False)
+        for _, group in positions
+    ]
+    return np.sort(np.concatenate(sample))
+
+
+def plot_songs(songs, embedding, dimensions=2):
+    songs = songs.assign(x=embedding[:, 0], y=embedding[:, 1])
     if dimensions == 3:
         songs["z"] = embedding[:, 2]
-    songs["title"] = songs["song_interpret"] + " - " + songs["song_title"]
-    not_in_hover = ["x", "y", "z", "playlist", "title","song_interpret", "song_title"]
+    not_in_hover = ["x", "y", "z", "playlist", "track_id", "title","song_interpret", "song_title"]
     hover_data = {col: (col not in not_in_hover) for col in songs.columns}
     plot_args = dict(
         color="playlist", 
@@ -110,7 +308,7 @@ def plot_songs(songs, dimensions=2):
         hover_data=hover_data,
     )
     if dimensions == 2:
-        fig = px.scatter(songs, x="x", y="y", **plot_args)
+        fig = px.scatter(songs, x="x", y="y", render_mode="webgl", **plot_args)
     elif dimensions == 3:
         plot_args["labels"]["z"] = ""
         fig = px.scatter_3d(songs, x="x", y="y", z="z", **plot_args)
@@ -132,10 +330,38 @@ def plot_songs(songs, dimensions=2):
     return fig
 
 
+KDE_GRID_SIZE = 200
+
+
+@st.cache_data
+def compute_kde(values, clip):
+    if len(np.unique(values)) < 2: # a density can't be estimated from a single value
+        return np.array([]), np.array([])
+    kde = gaussian_kde(values)
+    bandwidth = np.sqrt(kde.covariance[0, 0])
+    low, high = values.min() - 3 * bandwidth, values.max() + 3 * bandwidth # same padding as seaborn's default cut
+    if clip is not None:
+        low = low if clip[0] is None else max(low, clip[0])
+        high = high if clip[1] is None else min(high, clip[1])
+    xs = np.linspace(low, high, KDE_GRID_SIZE)
+    return xs, kde(xs)
+
+
+def hue_palette(songs, hue):
+    # one fixed colour per level, picked the way seaborn does by default, so count and density plots agree
+    levels = songs[hue].unique()
+    if len(levels) <= len(sns.color_palette()):
+        colors = sns.color_palette(n_colors=len(levels))
+    else:
+        colors = sns.color_palette("husl", len(levels))
+    return dict(zip(levels, colors))
+
+
 def plot_distribution(songs, audio_features, x, hue):
     audio_feature = audio_features.get(x)
+    palette = None if hue is None else hue_palette(songs, hue)
     if "value_map" in audio_feature.keys():
-        sns.countplot(songs, x=x, hue=hue)
+        sns.countplot(songs, x=x, hue=hue, palette=palette)
         value_map = audio_feature.get("value_map")
         plt.gca().set_xticklabels([value_map.get(str(label), label) for label in plt.gca().get_xticks()])
         plt.ylabel("Number of songs")
@@ -148,7 +374,15 @@ def plot_distribution(songs, audio_features, x, hue):
                 clip = (0, None) # no durations under 0 seconds
             case _:
                 clip = None
-        sns.kdeplot(songs, x=x, hue=hue, common_norm=False, clip=clip)
+        groups = [(None, songs[x])] if hue is None else songs.groupby(hue, sort=False)[x]
+        for label, values in groups:
+            xs, density = compute_kde(values.to_numpy(np.float64), clip)
+            color = sns.color_palette()[0] if hue is None else palette[label]
+            plt.plot(xs, density, color=color, label=label)
+            plt.fill_between(xs, density, color=color, alpha=0.2)
+        plt.xlabel(x)
+        if hue is not None:
+            plt.legend()
         if unit == "%":
             plt.gca().set_xticklabels([f'{x:.0%}' for x in plt.gca().get_xticks()]) 
         else:
@@ -180,18 +414,20 @@ with open("audio_features.json", "r") as infile:
 
 
 st.title("Clusterfy")
+warm_up_jit()
 A, B = st.columns(2)
 
 with A:
     user_id = st.text_input("User ID")
-    if st.button("Load profile", help="For every 10 songs this will take about 1 second."):
+    if st.button("Load profile", help="Loading many playlists can take a few seconds."):
         st.session_state["user_id"] = user_id
 
 user_id = st.session_state.get("user_id")
 if user_id in ["", None]:
     pass
 else:
-    user = load_profile(user_id)
+    spotify = login()
+    user = load_profile(spotify, user_id)
     with B:
         caption = f"Hello {user.display_name}!"
         if len(user.images) != 0:
@@ -199,7 +435,7 @@ else:
         else:
             st.caption(caption)
 
-    songs = load_playlists(user_id)
+    songs = load_playlists(spotify, user_id)
     if len(songs) == 0:
         st.warning("No public playlists.")
     else:
@@ -219,7 +455,7 @@ else:
             )
             x = st.selectbox(
                 "Dimension", 
-                songs.columns.difference(["playlist", "song_title", "song_interpret"]),
+                songs.columns.difference(["playlist", "track_id", "song_title", "song_interpret", "title"]),
             )
             audio_feature = audio_features.get(x)
             st.info(audio_feature.get("description"))
@@ -238,4 +474,11 @@ else:
                 "displayModeBar": False,
             }
             dims = st.radio("Map Type", [2, 3], horizontal=True, format_func=lambda x: f"{x}D")
-            st.plotly_chart(plot_songs(songs, dims), use_container_width=True, config=config)
+            playlists = st.multiselect("Playlists", songs.playlist.unique(), default=songs.playlist.unique())
+            embedding = embed_songs(songs, dims) # always embed the whole library, filtering only changes the view
+            shown = songs.playlist.isin(playlists).to_numpy()
+            shown_songs, shown_embedding = songs[shown], embedding[shown]
+            if len(shown_songs) > MAX_PLOT_POINTS and not st.checkbox("Show all points (slow)"):
+                sample = sample_per_playlist(shown_songs)
+                shown_songs, shown_embedding = shown_songs.iloc[sample], shown_embedding[sample]
+            st.plotly_chart(plot_songs(shown_songs, shown_embedding, dims), use_container_width=True, config=config)